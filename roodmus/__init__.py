@@ -27,7 +27,6 @@
 import os
 import pyworkflow.utils as pwutils
 import pwem
-import subprocess
 
 from roodmus.constants import *
 
@@ -84,28 +83,17 @@ class Plugin(pwem.Plugin):
     def defineBinaries(cls, env):
 
         def getRoodmusInstallationCommands():
-            nvidiaNVCC = False
-            try:
-                nvidiaDriverVer = subprocess.Popen(["nvidia-smi",
-                                                    "--query-gpu=driver_version",
-                                                    "--format=csv,noheader"],
-                                                   env=cls.getEnviron(),
-                                                   stdout=subprocess.PIPE
-                                                   ).stdout.read().decode('utf-8').split(".")[0]
-                nvidiaNVCC = subprocess.run(['nvcc', '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            except (ValueError, TypeError, FileNotFoundError):
-                print("NVCC not found in your system, installing it in the environment...")
-
+            # GPU/CUDA probing is done by the install command itself, so defining the binaries stays cheap
             commands = cls.getCondaActivationCmd() + " "
-            if nvidiaNVCC:
-                commands += f"conda create -n roodmus-{V1} -c conda-forge fftw python=3.10 -y && "
-            else:
-                compatible_versions = [cuda for drv, cuda in driver_cuda_compatibility.items() if
-                                       drv <= nvidiaDriverVer]
-                cudaVersion = max(compatible_versions)
-                commands += (
-                    f"conda create -n roodmus-{V1} -c conda-forge -c nvidia/label/cuda-{cudaVersion} python=3.10 "
-                    f"fftw cuda={cudaVersion} -y && ")
+            commands += ("DRIVER=$(nvidia-smi --query-gpu=driver_version --format=csv,noheader 2> /dev/null "
+                         "| head -n 1 | cut -d. -f1) && CUDA_VERSION='' && ")
+            for drv, cuda in driver_cuda_compatibility.items():
+                commands += f'if [ -n "$DRIVER" ] && [ "$DRIVER" -ge {drv} ]; then CUDA_VERSION={cuda}; fi && '
+            commands += ('if command -v nvcc > /dev/null || [ -z "$CUDA_VERSION" ]; then '
+                         f"conda create -n roodmus-{V1} -c conda-forge fftw python=3.10 -y; "
+                         'else echo "NVCC not found in your system, installing it in the environment..." && '
+                         f"conda create -n roodmus-{V1} -c conda-forge -c nvidia/label/cuda-$CUDA_VERSION "
+                         "python=3.10 fftw cuda=$CUDA_VERSION -y; fi && ")
             commands += f"conda activate roodmus-{V1} && "
             commands += "pip install roodmus && pip install openmm && "
             commands += ("git clone https://gitlab.com/ccpem/ccpem-pipeliner.git && "
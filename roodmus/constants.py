@@ -25,3 +25,8 @@
 # **************************************************************************
 
 V1 = "1.0.1"
+
+# Automatic device selection
+CALIBRATION_SIZE = 512  # Maximum micrograph size (pixels) used by the calibration runs
+CALIBRATION_FILE = "roodmus_calibration.json"  # Per host cache, stored in SCIPION_USER_DATA
+CALIBRATION_FILE_VAR = "ROODMUS_CALIBRATION_FILE"  # Environment variable to store the cache elsewhere
@@ -27,27 +27,63 @@
 
 
 import os
+import re
+import json
+import struct
+import time
+import socket
+import tempfile
 from glob import glob
-import yaml
-from scipy.spatial.transform import Rotation as R
 
 from enum import Enum
 
+import pyworkflow as pw
 from pyworkflow.constants import BETA
 import pyworkflow.protocol.params as params
-from pyworkflow.utils import Message, copyFile, getExt, replaceExt
-from pyworkflow.object import Set
+from pyworkflow.utils import Message, copyFile, getExt, replaceExt, cleanPath
+from pyworkflow.object import Set, Integer, String
 
 from pwem.protocols import EMProtocol
 from pwem.objects import Micrograph, SetOfMicrographs, CTFModel, Coordinate, Acquisition, SetOfCoordinates
 
 from roodmus import Plugin
+from roodmus.constants import CALIBRATION_SIZE, CALIBRATION_FILE, CALIBRATION_FILE_VAR
 
 
 class outputs(Enum):
     count = SetOfMicrographs
 
 
+CONFORMATION_PATTERN = re.compile(r"conformation_(\d+)")
+
+
+def getConformationSample(fileName):
+    """ Return the sample index encoded in a sampled conformation file name
+    (conformation_NNNNNN.pdb), or None if the name does not follow that pattern. """
+    match = CONFORMATION_PATTERN.search(os.path.basename(fileName))
+    return int(match.group(1)) if match else None
+
+
+def getDcdNumFrames(fileName):
+    """ Number of frames stored in a DCD trajectory, read from its header. """
+    with open(fileName, "rb") as stream:
+        header = stream.read(12)
+    for endian in "<>":
+        blockSize, magic, numFrames = struct.unpack(f"{endian}i4si", header)
+        if blockSize == 84 and magic == b"CORD":
+            return numFrames
+    raise Exception(f"{fileName} is not a valid DCD trajectory")
+
+
+def getSampledFrames(numFrames, numConf):
+    """ Trajectory frames picked by Roodmus conformations_sampling (even sampling over the concatenated
+    trajectories, as in roodmus get_traj_indices: round(linspace(0, numFrames - 1, numConf))). """
+    if numConf == 1:
+        return [0]
+    step = (numFrames - 1) / (numConf - 1)
+    return [int(round(idx * step)) for idx in range(numConf)]
+
+
 class ProtSimulateMicrographs(EMProtocol):
     """
     Simulation of micrographs with varying conformational variability with Roodmus
@@ -57,6 +93,11 @@ class ProtSimulateMicrographs(EMProtocol):
     _micModel = ["talos", "krios"]
     _possibleOutputs = outputs
 
+    def __init__(self, **kwargs):
+        EMProtocol.__init__(self, **kwargs)
+        self.calibratedDevice = String()
+        self.calibratedNproc = Integer()
+
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
         """ Define the input parameters that will be used.
@@ -73,6 +114,15 @@ class ProtSimulateMicrographs(EMProtocol):
                        expertLevel=params.LEVEL_ADVANCED,
                        label="Choose GPU IDs",
                        help="Add a list of GPU devices that can be used")
+        form.addParam('autoDevice', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label="Automatic device and processes selection?",
+                      help="If set, a short calibration simulation (small micrographs with the requested pixel "
+                           "size and ice thickness) is run on the available devices to choose the fastest device "
+                           "and number of processes. The choice is cached per host and parameter class (in "
+                           "SCIPION_USER_DATA, or the file given by ROODMUS_CALIBRATION_FILE), so "
+                           "calibration only runs the first time. The GPU and threads settings are then used as "
+                           "upper limits.")
 
         form.addParam('topFile', params.PointerParam,
                       pointerClass="AtomStruct",
@@ -176,6 +226,8 @@ class ProtSimulateMicrographs(EMProtocol):
     def _insertAllSteps(self):
         # Insert processing steps
         self._insertFunctionStep(self.sampleConformationsStep)
+        if self.autoDevice.get():
+            self._insertFunctionStep(self.calibrateDeviceStep)
         self._insertFunctionStep(self.simulateMicrographsStep)
         self._insertFunctionStep(self.createOutputStep)
 
@@ -191,50 +243,95 @@ class ProtSimulateMicrographs(EMProtocol):
             program = Plugin.getRoodmusProgram("conformations_sampling")
 
             self.runJob(program, args)
+
+            # Roodmus names the sampled conformations with a running counter, so keep which MD frame each one is
+            trajFiles = sorted(glob(os.path.join(trajFilesDir, "*.dcd")))
+            numFrames = sum(getDcdNumFrames(trajFile) for trajFile in trajFiles)
+            frames = dict(enumerate(getSampledFrames(numFrames, numConf)))
         else:
             os.mkdir(self._getExtraPath('simulated_conformations'))
             copyFile(topFile, self._getExtraPath(os.path.join('simulated_conformations',
                                                               f"conformation_000000.{getExt(topFile)}")))
+            # The topology is not part of any trajectory
+            frames = {0: None}
+
+        with open(self._getExtraPath("conformation_frames.json"), "w") as stream:
+            json.dump({str(sample): frame for sample, frame in frames.items()}, stream)
+
+    def calibrateDeviceStep(self):
+        key = self._getCalibrationKey()
+        cache = self._readCalibrationCache()
+
+        if key not in cache:
+            program = Plugin.getRoodmusProgram("run_parakeet")
+            nX, nY, numPart = self._getCalibrationSize()
+            # Every candidate simulates the same number of micrographs, so the fixed cost of each run
+            # (environment activation, imports, model loading) weighs the same on all of them
+            numMic = self._getMaxProcesses()
+            timings = {}
+            for device, nproc in self._getCalibrationCandidates():
+                outDir = self._getExtraPath(os.path.join('calibration', f"{device}_{nproc}"))
+                args = (self._getSimulationArgs(outDir, numMic, nX, nY, nproc, numPart=numPart) +
+                        self._getDeviceArgs(device))
+                start = time.time()
+                try:
+                    self.runJob(program, args)
+                    elapsed = time.time() - start
+                except Exception as e:
+                    self.info(f"Calibration with device {device} and {nproc} processes failed: {e}")
+                    continue
+                finally:
+                    cleanPath(outDir)
+                timings[f"{device}_{nproc}"] = elapsed
+                self.info(f"Calibration with device {device} and {nproc} processes: "
+                          f"{elapsed:.2f} s for {numMic} micrographs")
+
+            if not timings:
+                raise Exception("All calibration runs failed, please check the protocol logs.")
+
+            device, nproc = min(timings, key=timings.get).split("_")
+            cache[key] = {"device": device, "nproc": int(nproc)}
+            self._writeCalibrationCache({key: cache[key]})
+
+        self.calibratedDevice.set(cache[key]["device"])
+        self.calibratedNproc.set(cache[key]["nproc"])
+        self._store(self.calibratedDevice, self.calibratedNproc)
+        self.info(f"Selected device {self.calibratedDevice.get()} with {self.calibratedNproc.get()} processes")
 
     def simulateMicrographsStep(self):
-        numMic = self.numMic.get()
-        numPart = self.numPart.get()
-        pixelSize = self.pixelSize.get()
-        iceThickness = self.iceThickness.get()
-        nX = self.nX.get()
-        nY = self.nY.get()
-        centreX = round(0.5 * nX)
-        centreY = round(0.5 * nY)
-        centreZ = round(0.5 * iceThickness)
-
-        args = (f"--pdb_dir {self._getExtraPath('simulated_conformations')} "
-                f"--mrc_dir {self._getExtraPath('simulated_mics')} -n {numMic} -m {numPart} "
-                f"--pixel_size {pixelSize} --nx {nX} --ny {nY} --box_x {pixelSize * nX} "
-                f"--box_y {pixelSize * nY} --box_z {iceThickness} --centre_x {pixelSize * centreX} "
-                f"--centre_y {pixelSize * centreY} --centre_z {centreZ} --cuboid_length_x {pixelSize * nX} "
-                f"--cuboid_length_y {pixelSize * nY} --cuboid_length_z {iceThickness} --tqdm "
-                f"--nproc {self.numberOfThreads.get()} --electrons_per_angstrom {self.dose.get()} "
-                f"--c_10 {self.defocusAverage.get()} --c_10_stddev {self.defocusSTD.get()} ")
-                # f"--model {self._micModel[self.micModel.get()]}")  # FIXME: Currently a bug in Roodmus, to be added when fixed
-
-        if self.usesGpu():
-            gpuID = [str(elem) for elem in self.getGpuList()][0]
-            args += f' --device "gpu" --gpu_id {gpuID}'
+        if self.autoDevice.get():
+            device = self.calibratedDevice.get()
+            nproc = self.calibratedNproc.get()
         else:
-            args += f' --device "cpu"'
+            device = "gpu" if self.usesGpu() else "cpu"
+            nproc = self.numberOfThreads.get()
+
+        args = self._getSimulationArgs(self._getExtraPath('simulated_mics'), self.numMic.get(),
+                                       self.nX.get(), self.nY.get(), nproc)
+        args += self._getDeviceArgs(device)
 
         program = Plugin.getRoodmusProgram("run_parakeet")
 
         self.runJob(program, args)
 
     def createOutputStep(self):
+        import yaml  # Deferred so plugin import stays fast
+
         pixelSize = self.pixelSize.get()
         outputMics = self._createSetOfMicrographs()
         outputCTFs = self._createSetOfCTF()
         outputCoords = self._createSetOfCoordinates(outputMics)
         outputMics.setSamplingRate(pixelSize)
 
+        # Conformation labels follow the order of the sampled conformation files
+        confFiles = sorted(glob(self._getExtraPath(os.path.join('simulated_conformations', "conformation_*"))))
+        confLabels = {getConformationSample(confFile): idx for idx, confFile in enumerate(confFiles)}
+        with open(self._getExtraPath("conformation_frames.json")) as stream:
+            confFrames = {int(sample): frame for sample, frame in json.load(stream).items()}
+        confIndex = {}
+
         micId = 1
+        coordId = 1
         for micFile in glob(self._getExtraPath(os.path.join('simulated_mics'), "*.mrc")):
             with open(replaceExt(micFile, "yaml")) as stream:
                 yaml_contents = yaml.safe_load(stream)
@@ -262,16 +359,28 @@ class ProtSimulateMicrographs(EMProtocol):
             # outputMic.setCTF(ctf)
             outputCTFs.append(ctf)
 
-            # Output 3: Coordinates
-            for pick in yaml_contents["sample"]["molecules"]["local"][0]["instances"]:
-                # mat = R.from_euler(angles=pick["orientations"], seq="ZYZ", degrees=False).as_matrix()
-                coord = Coordinate()
-                coord.setX(int(round(pick["position"][0])))
-                coord.setY(int(round(pick["position"][1])))
-                coord.setMicrograph(outputMic)
-                coord.setMicName(outputMic.getMicName())
-                coord.setMicId(outputMic.getObjId())
-                outputCoords.append(coord)
+            # Output 3: Coordinates (each local molecule corresponds to one sampled conformation)
+            for molecule in yaml_contents["sample"]["molecules"]["local"]:
+                confSample = getConformationSample(molecule["filename"])
+                if confSample not in confLabels:
+                    raise Exception(f"Simulated molecule {molecule['filename']} in {micFile} does not match "
+                                    f"any sampled conformation in "
+                                    f"{self._getExtraPath('simulated_conformations')}")
+                confLabel = confLabels[confSample]
+                confFrame = confFrames.get(confSample)
+                for pick in molecule["instances"]:
+                    coord = Coordinate()
+                    coord.setObjId(coordId)
+                    coord.setX(int(round(pick["position"][0])))
+                    coord.setY(int(round(pick["position"][1])))
+                    coord.setMicrograph(outputMic)
+                    coord.setMicName(outputMic.getMicName())
+                    coord.setMicId(outputMic.getObjId())
+                    coord._roodmusConformation = Integer(confLabel)
+                    coord._roodmusFrame = Integer(confFrame)
+                    outputCoords.append(coord)
+                    confIndex.setdefault(confLabel, []).append(coordId)
+                    coordId += 1
 
             outputMics.append(outputMic)
             outputMics.setAcquisition(aquisition)
@@ -282,6 +391,12 @@ class ProtSimulateMicrographs(EMProtocol):
         outputCoords.setMicrographs(outputMics)
         outputCoords.setBoxSize(int(self.nX.get() / 10))
 
+        # Precomputed conformation -> coordinate IDs lookup, stored next to the outputs
+        confIndexFile = self._getExtraPath("conformation_index.json")
+        with open(confIndexFile, "w") as stream:
+            json.dump({str(label): ids for label, ids in sorted(confIndex.items())}, stream)
+        outputCoords._roodmusConformationIndex = String(confIndexFile)
+
         self._defineOutputs(simMics=outputMics, trueCTFs=outputCTFs, trueCoords=outputCoords)
         self._defineCtfRelation(outputMics, outputCTFs)
 
@@ -301,6 +416,9 @@ class ProtSimulateMicrographs(EMProtocol):
             summary.append(f"    - Number of particles per micrograph:  {numPart}")
             summary.append(f"    - Number of sampled conformations:  {numConf}")
             summary.append(f"    - Micrograph pixel size: {pixelSize}")
+            if self.autoDevice.get():
+                summary.append(f"    - Selected device: {self.calibratedDevice.get()} "
+                               f"({self.calibratedNproc.get()} processes)")
         else:
             summary.append("Simulating micrographs...")
 
@@ -308,3 +426,88 @@ class ProtSimulateMicrographs(EMProtocol):
 
     def _methods(self):
         pass
+
+    # --------------------------- UTILS functions -----------------------------------
+    def _getSimulationArgs(self, outDir, numMic, nX, nY, nproc, numPart=None):
+        numPart = numPart or self.numPart.get()
+        pixelSize = self.pixelSize.get()
+        iceThickness = self.iceThickness.get()
+        centreX = round(0.5 * nX)
+        centreY = round(0.5 * nY)
+        centreZ = round(0.5 * iceThickness)
+
+        args = (f"--pdb_dir {self._getExtraPath('simulated_conformations')} "
+                f"--mrc_dir {outDir} -n {numMic} -m {numPart} "
+                f"--pixel_size {pixelSize} --nx {nX} --ny {nY} --box_x {pixelSize * nX} "
+                f"--box_y {pixelSize * nY} --box_z {iceThickness} --centre_x {pixelSize * centreX} "
+                f"--centre_y {pixelSize * centreY} --centre_z {centreZ} --cuboid_length_x {pixelSize * nX} "
+                f"--cuboid_length_y {pixelSize * nY} --cuboid_length_z {iceThickness} --tqdm "
+                f"--nproc {nproc} --electrons_per_angstrom {self.dose.get()} "
+                f"--c_10 {self.defocusAverage.get()} --c_10_stddev {self.defocusSTD.get()} ")
+                # f"--model {self._micModel[self.micModel.get()]}")  # FIXME: Currently a bug in Roodmus, to be added when fixed
+        return args
+
+    def _getDeviceArgs(self, device):
+        if device == "gpu":
+            gpuID = [str(elem) for elem in self.getGpuList()][0]
+            return f' --device "gpu" --gpu_id {gpuID}'
+        else:
+            return f' --device "cpu"'
+
+    def _getCalibrationSize(self):
+        """ Micrograph size and number of particles of the calibration runs. The number of particles
+        is scaled with the micrograph area so the particle density matches the production run. """
+        nX = min(self.nX.get(), CALIBRATION_SIZE)
+        nY = min(self.nY.get(), CALIBRATION_SIZE)
+        numPart = max(1, round(self.numPart.get() * (nX * nY) / (self.nX.get() * self.nY.get())))
+        return nX, nY, numPart
+
+    def _getMaxProcesses(self):
+        """ Largest number of processes the simulation can use: one micrograph per process at most. """
+        return max(1, min(self.numberOfThreads.get(), self.numMic.get()))
+
+    def _getCalibrationCandidates(self):
+        """ (device, nproc) pairs to be timed: halving the maximum number of processes down to one,
+        on CPU and, if GPU usage is enabled, on the first GPU. """
+        nprocs = []
+        nproc = self._getMaxProcesses()
+        while nproc >= 1:
+            nprocs.append(nproc)
+            nproc //= 2
+        devices = ["gpu", "cpu"] if self.usesGpu() and self.getGpuList() else ["cpu"]
+        return [(device, nproc) for device in devices for nproc in nprocs]
+
+    def _getCalibrationKey(self):
+        """ Host and parameter class the calibration is valid for. Pixel size and ice thickness are
+        bucketed so that close values share the same calibration. """
+        gpus = (",".join(str(gpu) for gpu in self.getGpuList()) if self.usesGpu() else "") or "none"
+        return (f"{socket.gethostname()}:pixel_{self.pixelSize.get():.1f}:ice_{round(self.iceThickness.get(), -2):.0f}:"
+                f"nproc_{self._getMaxProcesses()}:gpus_{gpus}")
+
+    def _getCalibrationFile(self):
+        return os.environ.get(CALIBRATION_FILE_VAR, os.path.join(pw.Config.SCIPION_USER_DATA, CALIBRATION_FILE))
+
+    def _readCalibrationCache(self):
+        calibrationFile = self._getCalibrationFile()
+        if os.path.isfile(calibrationFile):
+            try:
+                with open(calibrationFile) as stream:
+                    return json.load(stream)
+            except (OSError, ValueError) as e:
+                self.warning(f"Ignoring unreadable calibration cache {calibrationFile}: {e}")
+        return {}
+
+    def _writeCalibrationCache(self, entries):
+        # Re-read so calibrations stored by other runs in the meantime are kept. The cache may be shared
+        # by several nodes, so it is replaced atomically instead of being rewritten in place
+        calibrationFile = self._getCalibrationFile()
+        cache = {**self._readCalibrationCache(), **entries}
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(calibrationFile),
+                                         prefix=".roodmus_calibration_", delete=False) as stream:
+            json.dump(cache, stream, indent=2)
+        os.replace(stream.name, calibrationFile)
+
+    def getConformationIndex(self):
+        """ Return the conformation -> list of coordinate IDs lookup stored with the outputs. """
+        with open(self._getExtraPath("conformation_index.json")) as stream:
+            return {int(label): ids for label, ids in json.load(stream).items()}
@@ -25,17 +25,29 @@
 # *
 # **************************************************************************
 
+import os
+import json
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+from unittest import mock
 
 from pyworkflow.tests import *
 
+from pyworkflow.protocol.params import USE_GPU, GPU_LIST
 from pwem.protocols import ProtImportPdb
 
+from roodmus.constants import CALIBRATION_FILE_VAR
 from roodmus.protocols import ProtSimulateMicrographs
+from roodmus.protocols.protocol_simulate_micrographs import (getConformationSample, getDcdNumFrames,
+                                                               getSampledFrames)
 
 
 class TestRoodmusBase(BaseTest):
 
-    def runRoodmus(self, pdbID):
+    def importModel(self, pdbID):
         print("Import atomic model")
         protImportModel = self.newProtocol(ProtImportPdb,
                                            pdbId=pdbID,
@@ -43,6 +55,10 @@ class TestRoodmusBase(BaseTest):
         self.launchProtocol(protImportModel)
         self.assertIsNotNone(protImportModel.getStatus(),
                              "There was a problem with the import")
+        return protImportModel
+
+    def runRoodmus(self, pdbID):
+        protImportModel = self.importModel(pdbID)
 
         print("Run Roodmus")
         protSimMic = self.newProtocol(ProtSimulateMicrographs,
@@ -57,6 +73,65 @@ class TestRoodmusBase(BaseTest):
         self.assertIsNotNone(protSimMic.trueCoords,
                              "There was a problem with simple initial model protocol")
 
+        confIndex = protSimMic.getConformationIndex()
+        indexedIds = [coordId for ids in confIndex.values() for coordId in ids]
+        self.assertEqual(len(indexedIds), len(set(indexedIds)),
+                         "Coordinates repeated in the conformation index")
+        coordIds = []
+        for coord in protSimMic.trueCoords.iterItems():
+            coordIds.append(coord.getObjId())
+            self.assertIn(coord.getObjId(), confIndex[coord._roodmusConformation.get()],
+                          "Coordinate missing from the conformation index")
+            # Without trajectories the only conformation is the topology, which is not an MD frame
+            self.assertIsNone(coord._roodmusFrame.get(),
+                              "Topology conformation should not have a trajectory frame")
+        self.assertCountEqual(indexedIds, coordIds,
+                              "Conformation index does not match the output coordinates")
+
+    def runRoodmusAuto(self, pdbID):
+        # Keep the calibration of the test away from the user's cache (launched protocols inherit it)
+        calibrationFile = os.path.join(tempfile.mkdtemp(), "calibration.json")
+        with mock.patch.dict(os.environ, {CALIBRATION_FILE_VAR: calibrationFile}):
+            self._runRoodmusAuto(pdbID, calibrationFile)
+
+    def _runRoodmusAuto(self, pdbID, calibrationFile):
+        protImportModel = self.importModel(pdbID)
+
+        def newAutoProtocol():
+            return self.newProtocol(ProtSimulateMicrographs,
+                                    topFile=protImportModel.outputPdb,
+                                    autoDevice=True,
+                                    numMic=2,
+                                    numberOfThreads=2,
+                                    **{USE_GPU: False})
+
+        print("Run Roodmus with automatic device selection")
+        protCalibrate = newAutoProtocol()
+        self.assertEqual(protCalibrate._getCalibrationFile(), calibrationFile)
+        self.launchProtocol(protCalibrate)
+        self.assertEqual(protCalibrate.calibratedDevice.get(), "cpu",
+                         "Calibration selected a device other than CPU")
+        self.assertIn(protCalibrate.calibratedNproc.get(), [2, 1],
+                      "Calibration selected an invalid number of processes")
+        calibrationDir = protCalibrate._getExtraPath('calibration')
+        self.assertFalse(os.path.isdir(calibrationDir) and os.listdir(calibrationDir),
+                         "Calibration micrographs were not removed")
+        with open(calibrationFile) as stream:
+            self.assertEqual(json.load(stream)[protCalibrate._getCalibrationKey()],
+                             {"device": protCalibrate.calibratedDevice.get(),
+                              "nproc": protCalibrate.calibratedNproc.get()})
+        cacheTime = os.path.getmtime(calibrationFile)
+
+        print("Run Roodmus reusing the calibration")
+        protCached = newAutoProtocol()
+        self.launchProtocol(protCached)
+        self.assertEqual(protCached.calibratedDevice.get(), protCalibrate.calibratedDevice.get())
+        self.assertEqual(protCached.calibratedNproc.get(), protCalibrate.calibratedNproc.get())
+        self.assertEqual(os.path.getmtime(calibrationFile), cacheTime,
+                         "Calibration was not reused from the cache")
+        self.assertIsNotNone(protCached.trueCoords,
+                             "There was a problem with simple initial model protocol")
+
 
 class TestRoodmus(TestRoodmusBase):
     @classmethod
@@ -65,3 +140,179 @@ class TestRoodmus(TestRoodmusBase):
 
     def test_roodmus(self):
         self.runRoodmus("4ake")
+
+    def test_roodmusAutoDevice(self):
+        self.runRoodmusAuto("4ake")
+
+
+class TestRoodmusCalibration(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+
+    def newCalibrationProtocol(self, **kwargs):
+        return self.newProtocol(ProtSimulateMicrographs, autoDevice=True, **kwargs)
+
+    def test_calibrationCandidates(self):
+        for threads, nprocs in [(1, [1]), (4, [4, 2, 1]), (5, [5, 2, 1])]:
+            protCpu = self.newCalibrationProtocol(numberOfThreads=threads, **{USE_GPU: False})
+            self.assertEqual(protCpu._getCalibrationCandidates(), [("cpu", n) for n in nprocs])
+
+            protGpu = self.newCalibrationProtocol(numberOfThreads=threads, **{USE_GPU: True, GPU_LIST: "0"})
+            self.assertEqual(protGpu._getCalibrationCandidates(),
+                             [("gpu", n) for n in nprocs] + [("cpu", n) for n in nprocs])
+
+        # Production never uses more processes than micrographs
+        prot = self.newCalibrationProtocol(numberOfThreads=8, numMic=3, **{USE_GPU: False})
+        self.assertEqual(prot._getCalibrationCandidates(), [("cpu", 3), ("cpu", 1)])
+
+    def test_calibrationSize(self):
+        prot = self.newCalibrationProtocol(nX=4096, nY=4096, numPart=300)
+        self.assertEqual(prot._getCalibrationSize(), (512, 512, 5))
+        prot = self.newCalibrationProtocol(nX=4096, nY=4096, numPart=10)
+        self.assertEqual(prot._getCalibrationSize(), (512, 512, 1))
+        prot = self.newCalibrationProtocol(nX=400, nY=300, numPart=10)
+        self.assertEqual(prot._getCalibrationSize(), (400, 300, 10))
+
+    def test_calibrationKey(self):
+        def key(pixelSize, iceThickness):
+            return self.newCalibrationProtocol(pixelSize=pixelSize, iceThickness=iceThickness,
+                                               numberOfThreads=4, **{USE_GPU: False})._getCalibrationKey()
+
+        self.assertTrue(key(1.0, 500).startswith(socket.gethostname()))
+        self.assertEqual(key(1.02, 480), key(0.98, 520))
+        self.assertNotEqual(key(1.0, 500), key(1.2, 500))
+        self.assertNotEqual(key(1.0, 500), key(1.0, 700))
+
+        # GPUs only take part in the key when they are used
+        cpuKey = self.newCalibrationProtocol(**{USE_GPU: False, GPU_LIST: "0"})._getCalibrationKey()
+        gpuKey = self.newCalibrationProtocol(**{USE_GPU: True, GPU_LIST: "0"})._getCalibrationKey()
+        self.assertTrue(cpuKey.endswith("gpus_none"))
+        self.assertTrue(gpuKey.endswith("gpus_0"))
+
+    def test_calibrationCache(self):
+        prot = self.newCalibrationProtocol()
+        calibrationFile = os.path.join(tempfile.mkdtemp(), "calibration.json")
+        with mock.patch.dict(os.environ, {CALIBRATION_FILE_VAR: calibrationFile}):
+            self.assertEqual(prot._getCalibrationFile(), calibrationFile)
+            self._checkCalibrationCache(prot, calibrationFile)
+
+    def _checkCalibrationCache(self, prot, calibrationFile):
+
+        self.assertEqual(prot._readCalibrationCache(), {})
+        prot._writeCalibrationCache({"hostA": {"device": "gpu", "nproc": 2}})
+        prot._writeCalibrationCache({"hostB": {"device": "cpu", "nproc": 4}})
+        self.assertEqual(prot._readCalibrationCache(),
+                         {"hostA": {"device": "gpu", "nproc": 2}, "hostB": {"device": "cpu", "nproc": 4}})
+
+        # A corrupt cache (e.g. truncated by a concurrent writer) is treated as empty
+        with open(calibrationFile, "w") as stream:
+            stream.write('{"hostA": {"dev')
+        self.assertEqual(prot._readCalibrationCache(), {})
+        prot._writeCalibrationCache({"hostB": {"device": "cpu", "nproc": 4}})
+        self.assertEqual(prot._readCalibrationCache(), {"hostB": {"device": "cpu", "nproc": 4}})
+
+
+class TestRoodmusConformations(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+
+    def test_getConformationSample(self):
+        self.assertEqual(getConformationSample("/tmp/simulated_conformations/conformation_000123.pdb"), 123)
+        self.assertEqual(getConformationSample("conformation_000000.cif"), 0)
+        self.assertIsNone(getConformationSample("/tmp/4ake.pdb"))
+
+    def test_getSampledFrames(self):
+        self.assertEqual(getSampledFrames(100, 10), [0, 11, 22, 33, 44, 55, 66, 77, 88, 99])
+        self.assertEqual(getSampledFrames(11, 4), [0, 3, 7, 10])
+        self.assertEqual(getSampledFrames(50, 1), [0])
+
+    def test_getDcdNumFrames(self):
+        for endian in "<>":
+            dcdFile = os.path.join(tempfile.mkdtemp(), "traj.dcd")
+            with open(dcdFile, "wb") as stream:
+                stream.write(struct.pack(f"{endian}i4si", 84, b"CORD", 42) + bytes(80))
+            self.assertEqual(getDcdNumFrames(dcdFile), 42)
+
+    def newSimulatedProtocol(self, micrographs):
+        """ Protocol whose extra folder looks like a finished simulation of three conformations sampled at
+        frames 0, 50 and 99. micrographs maps each micrograph name to its local molecules as
+        (conformation file, [x positions]). """
+        prot = self.newProtocol(ProtSimulateMicrographs, numConf=3)
+        self.saveProtocol(prot)
+        prot.makePathsAndClean()
+
+        confDir = prot._getExtraPath("simulated_conformations")
+        micDir = prot._getExtraPath("simulated_mics")
+        os.makedirs(confDir)
+        os.makedirs(micDir)
+        for sample in range(3):
+            open(os.path.join(confDir, f"conformation_{sample:06d}.pdb"), "w").close()
+        with open(prot._getExtraPath("conformation_frames.json"), "w") as stream:
+            json.dump({"0": 0, "1": 50, "2": 99}, stream)
+
+        for micName, molecules in micrographs.items():
+            open(os.path.join(micDir, f"{micName}.mrc"), "w").close()
+            contents = {"microscope": {"beam": {"energy": 300, "electrons_per_angstrom": 45},
+                                       "lens": {"c_c": 2.7, "c_10": -15000, "phi_12": 0}},
+                        "sample": {"molecules": {"local": [
+                            {"filename": os.path.join(confDir, confFile),
+                             "instances": [{"position": [x, 100, 250], "orientation": [0, 0, 0]} for x in xs]}
+                            for confFile, xs in molecules]}}}
+            # JSON is valid YAML
+            with open(os.path.join(micDir, f"{micName}.yaml"), "w") as stream:
+                json.dump(contents, stream)
+        return prot
+
+    def test_createOutputStep(self):
+        prot = self.newSimulatedProtocol({
+            "mic_a": [("conformation_000000.pdb", [10, 20]), ("conformation_000002.pdb", [30])],
+            "mic_b": [("conformation_000001.pdb", [40]), ("conformation_000002.pdb", [50])]})
+        prot.createOutputStep()
+
+        # x position -> (conformation label, MD frame)
+        expected = {10: (0, 0), 20: (0, 0), 30: (2, 99), 40: (1, 50), 50: (2, 99)}
+        expectedIndex = {}
+        for coord in prot.trueCoords.iterItems():
+            label, frame = expected.pop(coord.getX())
+            self.assertEqual(coord._roodmusConformation.get(), label)
+            self.assertEqual(coord._roodmusFrame.get(), frame)
+            expectedIndex.setdefault(label, []).append(coord.getObjId())
+        self.assertFalse(expected, "Some simulated particles are missing from the output coordinates")
+
+        with open(prot._getExtraPath("conformation_index.json")) as stream:
+            self.assertEqual(json.load(stream),
+                             {str(label): sorted(ids) for label, ids in expectedIndex.items()})
+        self.assertEqual({label: sorted(ids) for label, ids in prot.getConformationIndex().items()},
+                         {label: sorted(ids) for label, ids in expectedIndex.items()})
+
+    def test_createOutputStepUnmatchedMolecule(self):
+        prot = self.newSimulatedProtocol({"mic_a": [("conformation_000009.pdb", [10])]})
+        with self.assertRaises(Exception):
+            prot.createOutputStep()
+
+
+class TestRoodmusImport(BaseTest):
+    """ Scipion imports every plugin at startup, so importing Roodmus must stay cheap. """
+    # scipy is already loaded by pwem itself, so it is not checked here
+    HEAVY_MODULES = ["yaml"]
+
+    def test_importTime(self):
+        # Import pwem first so only the modules and time added by the plugin are measured
+        code = ("import sys, time, json; t0 = time.perf_counter(); import pwem.protocols; "
+                "t1 = time.perf_counter(); before = set(sys.modules); import roodmus.protocols; "
+                "t2 = time.perf_counter(); "
+                "print(json.dumps({'baseline': t1 - t0, 'elapsed': t2 - t1, "
+                "'loaded': sorted(set(sys.modules) - before)}))")
+        result = json.loads(subprocess.check_output([sys.executable, "-c", code], text=True))
+
+        for module in self.HEAVY_MODULES:
+            self.assertNotIn(module, result["loaded"],
+                             f"Importing the Roodmus plugin loads {module}, import it where it is used")
+
+        # Secondary check: the plugin should only add a small fraction of what pwem itself costs
+        budget = max(0.1, 0.25 * result["baseline"])
+        print(f"Roodmus plugin import took {result['elapsed']:.3f} s (pwem {result['baseline']:.3f} s)")
+        self.assertLess(result["elapsed"], budget,
+                        f"Importing the Roodmus plugin took {result['elapsed']:.3f} s (budget {budget:.3f} s)")